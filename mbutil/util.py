@@ -9,6 +9,7 @@
 # for additional reference on schema see:
 # https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
 
+import hashlib
 import json
 import logging
 import os
@@ -17,13 +18,48 @@ import sqlite3
 import sys
 import time
 import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, groupby
 
 logger = logging.getLogger(__name__)
 
+_DIGITS_RE = re.compile(r"[^\d]")
+
+# bulk insert statements, kept as constants so every executemany call
+# hits sqlite3's prepared statement cache
+_INSERT_TILE_SQL = """INSERT INTO tiles
+    (zoom_level, tile_column, tile_row, tile_data)
+    VALUES (?, ?, ?, ?)"""
+_INSERT_IMAGE_SQL = """insert into images
+    (tile_id, tile_data)
+    values (?, ?)"""
+_INSERT_MAP_SQL = """insert into map
+    (zoom_level, tile_column, tile_row, tile_id)
+    values (?, ?, ?, ?)"""
+
 def flip_y(zoom, y):
     return (2**zoom-1) - y
 
+def _raise(error):
+    raise error
+
+def _to_int(name):
+    try:
+        return int(name)
+    except ValueError:
+        return int(_DIGITS_RE.sub("", name))
+
 def mbtiles_setup(cur):
+    mbtiles_setup_tables(cur)
+    mbtiles_setup_indices(cur)
+
+def mbtiles_setup_tables(cur):
+    # only take effect before the first table is created and while the
+    # database is not in WAL mode
+    cur.execute("""PRAGMA page_size=8192""")
+    cur.execute("""PRAGMA auto_vacuum=NONE""")
     cur.execute("""
         create table tiles (
             zoom_level integer,
@@ -37,6 +73,8 @@ def mbtiles_setup(cur):
     tile_row integer, grid blob);""")
     cur.execute("""CREATE TABLE grid_data (zoom_level integer, tile_column
     integer, tile_row integer, key_name text, key_json text);""")
+
+def mbtiles_setup_indices(cur):
     cur.execute("""create unique index name on metadata (name);""")
     cur.execute("""create unique index tile_index on tiles
         (zoom_level, tile_column, tile_row);""")
@@ -52,9 +90,23 @@ def mbtiles_connect(mbtiles_file, silent):
         sys.exit(1)
 
 def optimize_connection(cur):
-    cur.execute("""PRAGMA synchronous=0""")
+    cur.execute("""PRAGMA synchronous=NORMAL""")
     cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
+    cur.execute("""PRAGMA journal_mode=WAL""")
+    cur.execute("""PRAGMA temp_store=MEMORY""")
+    cur.execute("""PRAGMA cache_size=-65536""")
+    cur.execute("""PRAGMA mmap_size=1073741824""")
+
+def vacuum_database(cur, con):
+    # Workaround for python>=3.6.0,python<3.6.2
+    # https://bugs.python.org/issue28518
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    # WAL is only used while importing. Leave the finished file with a
+    # rollback journal so it can still be opened from read-only locations
     cur.execute("""PRAGMA journal_mode=DELETE""")
+    cur.execute("""vacuum;""")
+    con.isolation_level = isolation_level
 
 def compression_prepare(cur, silent):
     if not silent: 
@@ -62,14 +114,15 @@ def compression_prepare(cur, silent):
     cur.execute("""
       CREATE TABLE if not exists images (
         tile_data blob,
-        tile_id integer);
+        tile_id integer primary key);
     """)
     cur.execute("""
       CREATE TABLE if not exists map (
         zoom_level integer,
         tile_column integer,
         tile_row integer,
-        tile_id integer);
+        tile_id integer,
+        primary key (zoom_level, tile_column, tile_row)) without rowid;
     """)
 
 
@@ -80,11 +133,7 @@ def optimize_database(con, silent):
     cur.execute("""ANALYZE;""")
     if not silent:
         logger.debug('cleaning db')
-
-    # Seadista isolation_level ühenduse objektil, mitte kursoril
-    con.isolation_level = None  # Workaround for sqlite3 vacuum operatsioon
-    cur.execute("""VACUUM;""")
-    con.isolation_level = ''  # Taasta vaikimisi isolation_level
+    vacuum_database(cur, con)
 
     cur.execute("""ANALYZE;""")
 
@@ -99,52 +148,46 @@ def compression_do(cur, con, chunk, silent):
     res = cur.fetchone()
     total_tiles = res[0]
     last_id = 0
+    # tile_data digest -> tile_id of the first identical image
+    seen = {}
+    map_rows = []
+    image_rows = []
     if not silent:
         logging.debug("%d total tiles to fetch" % total_tiles)
-    for i in range(total_tiles // chunk + 1):
-        if not silent:
-            logging.debug("%d / %d rounds done" % (i, (total_tiles / chunk)))
-        ids = []
-        files = []
-        start = time.time()
-        cur.execute("""select zoom_level, tile_column, tile_row, tile_data
-            from tiles where rowid > ? and rowid <= ?""", ((i * chunk), ((i + 1) * chunk)))
-        if not silent:
-            logger.debug("select: %s" % (time.time() - start))
-        rows = cur.fetchall()
-        for r in rows:
-            total = total + 1
-            if r[3] in files:
-                overlapping = overlapping + 1
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                if not silent:
-                    logger.debug("insert: %s" % (time.time() - start))
-                cur.execute(query, (r[0], r[1], r[2], ids[files.index(r[3])]))
-            else:
-                unique = unique + 1
-                last_id += 1
 
-                ids.append(last_id)
-                files.append(r[3])
+    con.isolation_level = None
+    con.execute("BEGIN")
+    # a single scan over tiles, buffered rows are flushed every `chunk` tiles
+    for r in con.execute("""select zoom_level, tile_column, tile_row, tile_data
+            from tiles"""):
+        total = total + 1
+        key = hashlib.blake2b(r[3], digest_size=16).digest()
+        tile_id = seen.get(key)
+        if tile_id is not None:
+            overlapping = overlapping + 1
+        else:
+            unique = unique + 1
+            last_id += 1
+            tile_id = seen[key] = last_id
+            image_rows.append((tile_id, r[3]))
+        map_rows.append((r[0], r[1], r[2], tile_id))
+
+        if len(map_rows) >= chunk:
+            compression_flush(con, map_rows, image_rows)
+            con.execute("BEGIN")
+            if not silent:
+                logging.debug("%d / %d tiles done" % (total, total_tiles))
+    compression_flush(con, map_rows, image_rows)
+    con.isolation_level = ''
+    if not silent:
+        logging.debug("%d unique and %d overlapping tiles" % (unique, overlapping))
 
-                start = time.time()
-                query = """insert into images
-                    (tile_id, tile_data)
-                    values (?, ?)"""
-                cur.execute(query, (str(last_id), sqlite3.Binary(r[3])))
-                if not silent:
-                    logger.debug("insert into images: %s" % (time.time() - start))
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                cur.execute(query, (r[0], r[1], r[2], last_id))
-                if not silent:
-                    logger.debug("insert into map: %s" % (time.time() - start))
-        con.commit()
+def compression_flush(con, map_rows, image_rows):
+    con.executemany(_INSERT_IMAGE_SQL, image_rows)
+    con.executemany(_INSERT_MAP_SQL, map_rows)
+    con.commit()
+    map_rows.clear()
+    image_rows.clear()
 
 def compression_finalize(cur, con, silent):
     if not silent:
@@ -156,24 +199,14 @@ def compression_finalize(cur, con, silent):
         map.tile_row as tile_row,
         images.tile_data as tile_data FROM
         map JOIN images on images.tile_id = map.tile_id;""")
-    cur.execute("""
-          CREATE UNIQUE INDEX map_index on map
-            (zoom_level, tile_column, tile_row);""")
-    cur.execute("""
-          CREATE UNIQUE INDEX images_id on images
-            (tile_id);""")
-
-    # Workaround for python>=3.6.0,python<3.6.2
-    # https://bugs.python.org/issue28518
-    con.isolation_level = None
-    cur.execute("""vacuum;""")
-    con.isolation_level = ''  # reset default value of isolation_level
+    vacuum_database(cur, con)
 
     cur.execute("""analyze;""")
 
-def get_dirs(path):
-    return [name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name))]
+def read_tile(tile):
+    z, x, y, tile_path = tile
+    with open(tile_path, 'rb') as tile_file:
+        return z, x, y, memoryview(tile_file.read())
 
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     silent = kwargs.get('silent')
@@ -185,8 +218,10 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     # Ühendus MBTiles failiga
     con = mbtiles_connect(mbtiles_file, silent)
     cur = con.cursor()
+    # Tabelid luuakse enne WAL-režiimi, et page_size jõustuks kohe
+    # Indeksid luuakse alles pärast tile'ide sisestamist
+    mbtiles_setup_tables(cur)
     optimize_connection(cur)
-    mbtiles_setup(cur)
 
     # Metaandmete lugemine ja vaikimisi pildiformaat
     image_format = kwargs.get('format', 'pbf')  # Vaikimisi pbf
@@ -210,59 +245,76 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     count = 0
     start_time = time.time()
 
-    # Zoomi kaustade järjestamine väiksemast suurimani
-    zoom_levels = sorted(get_dirs(directory_path), key=lambda z: int(re.sub(r"[^\d]", "", z)))
-
-    for zoom_dir in zoom_levels:
-        z = int(re.sub(r"[^\d]", "", zoom_dir))  # Võta zoomi taseme number
-        zoom_path = os.path.join(directory_path, zoom_dir)
-
-        for row_dir in sorted(get_dirs(zoom_path)):
-            x = int(re.sub(r"[^\d]", "", row_dir))  # Tile'i veeru number
-            row_path = os.path.join(zoom_path, row_dir)
-
-            for current_file in sorted(os.listdir(row_path)):
-                # Süsteemifailide ignoreerimine
-                if current_file.startswith("."):
-                    continue
-
-                # Failinime ja laiendi jagamine
-                file_name, ext = os.path.splitext(current_file)
-                ext = ext.lstrip('.')  # Eemalda juhtiv punkt
+    # 1. faas: üks os.walk läbimine ja tile'ide nimekirja koostamine.
+    # Järjestus pole oluline, sest unikaalne indeks luuakse hiljem
+    tiles = []
+    # Loetamatu kaust katkestab impordi, mitte ei jäeta vaikselt vahele
+    for root, dirs, names in os.walk(directory_path, onerror=_raise, followlinks=True):
+        parts = os.path.relpath(root, directory_path).split(os.sep)
+        if len(parts) != 2:
+            continue
+        # z/x kaustadest sügavamale ei minda
+        dirs[:] = []
+        z = _to_int(parts[0])  # Võta zoomi taseme number
+        x = _to_int(parts[1])  # Tile'i veeru number
+
+        for current_file in names:
+            # Süsteemifailide ignoreerimine
+            if current_file.startswith("."):
+                continue
+
+            # Failinime ja laiendi jagamine
+            file_name, ext = os.path.splitext(current_file)
+            ext = ext.lstrip('.')  # Eemalda juhtiv punkt
+
+            if ext != image_format:
+                if not silent:
+                    logger.warning(f"Skipping {current_file} (not {image_format})")
+                continue
 
-                if ext != image_format:
-                    if not silent:
-                        logger.warning(f"Skipping {current_file} (not {image_format})")
-                    continue
+            # Tile'i rea number
+            y = int(file_name)
 
-                # Tile'i rea number ja faili sisu
-                y = int(file_name)
-                tile_path = os.path.join(row_path, current_file)
-                with open(tile_path, 'rb') as tile_file:
-                    tile_data = tile_file.read()
+            # Y-telje peegeldamine TMS-skeemi puhul
+            if scheme == 'tms':
+                y = flip_y(z, y)
 
-                # Y-telje peegeldamine TMS-skeemi puhul
-                if scheme == 'tms':
-                    y = flip_y(z, y)
+            tiles.append((z, x, y, os.path.join(root, current_file)))
 
-                # Tile'i andmete sisestamine andmebaasi
-                cur.execute("""
-                    INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)
-                    VALUES (?, ?, ?, ?)
-                """, (z, x, y, sqlite3.Binary(tile_data)))
+    # Kõik sisestused ühes tehingus, commit iga 10000 tile'i järel
+    con.isolation_level = None
+    con.execute("BEGIN")
+
+    # 2. faas: failid loetakse lõimede kaupa, SQLite'i kirjutab ainult põhilõim.
+    # Järgmise partii lugemine käib samal ajal eelmise sisestamisega,
+    # mälus on korraga kuni kaks partiid
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
+        reads = executor.map(read_tile, tiles[:1000])
+        for i in range(0, len(tiles), 1000):
+            batch = list(reads)
+            reads = executor.map(read_tile, tiles[i + 1000:i + 2000])
+            con.executemany(_INSERT_TILE_SQL, batch)
+
+            count += len(batch)
+            if count % 10000 == 0:
+                con.commit()
+                con.execute("BEGIN")
+            if not silent:
+                elapsed_time = time.time() - start_time
+                logger.info(f"{count} tiles inserted ({count / elapsed_time:.2f} tiles/sec)")
 
-                count += 1
-                if count % 100 == 0 and not silent:
-                    elapsed_time = time.time() - start_time
-                    logger.info(f"{count} tiles inserted ({count / elapsed_time:.2f} tiles/sec)")
+    con.commit()
+    con.isolation_level = ''
 
     if not silent:
         logger.info(f"Inserted {count} tiles in total.")
 
+    mbtiles_setup_indices(cur)
+
     # Kui kompressioon on lubatud, tee vajalikud sammud
     if kwargs.get('compression', False):
         compression_prepare(cur, silent)
-        compression_do(cur, con, 256, silent)
+        compression_do(cur, con, 5000, silent)
         compression_finalize(cur, con, silent)
 
     # Optimeeri andmebaas ja sulge ühendus
@@ -283,8 +335,35 @@ def mbtiles_metadata_to_disk(mbtiles_file, **kwargs):
     if not silent:
         logger.debug(json.dumps(metadata, indent=2))
 
+def write_tile(tile, data):
+    # data is either the tile bytes or an open sqlite3 Blob
+    fd = os.open(tile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        size = len(data)
+        if size > 1048576 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass
+        if isinstance(data, (bytes, memoryview)):
+            pieces = (data,)
+        else:
+            pieces = iter(lambda: data.read(65536), b'')
+        for piece in pieces:
+            view = memoryview(piece)
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def decode_grid(grid):
+    return json.loads(zlib.decompress(grid))
+
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     silent = kwargs.get('silent')
+    scheme = kwargs.get('scheme')
+    out_format = kwargs.get('format', 'png')
+    callback = kwargs.get('callback')
     if not silent:
         logger.debug("Exporting MBTiles to disk")
         logger.debug("%s --> %s" % (mbtiles_file, directory_path))
@@ -313,74 +392,103 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         formatter_json = {"formatter":formatter}
         open(layer_json, 'w').write(json.dumps(formatter_json))
 
-    tiles = con.execute(
-        'select zoom_level, tile_column, tile_row, tile_data from tiles ORDER BY zoom_level ASC;')
-    t = tiles.fetchone()
-    while t:
-        z = t[0]
-        x = t[1]
-        y = t[2]
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(z,y)
-            if not silent:
-                logger.debug('flipping')
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        elif kwargs.get('scheme') == 'wms':
-            tile_dir = os.path.join(base_path,
-                "%02d" % (z),
-                "%03d" % (int(x) / 1000000),
-                "%03d" % ((int(x) / 1000) % 1000),
-                "%03d" % (int(x) % 1000),
-                "%03d" % (int(y) / 1000000),
-                "%03d" % ((int(y) / 1000) % 1000))
-        else:
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
-        if kwargs.get('scheme') == 'wms':
-            tile = os.path.join(tile_dir,'%03d.%s' % (int(y) % 1000, kwargs.get('format', 'png')))
-        else:
-            tile = os.path.join(tile_dir, f'{y}.{image_format}')
-        f = open(tile, 'wb')
-        f.write(t[3])
-        f.close()
-        done = done + 1
-        if not silent:
-            logger.info('%s / %s tiles exported' % (done, count))
+    # tiles over 1 MiB are streamed straight to their files when tiles is a
+    # real table (compressed files expose tiles as a view, which has no
+    # rowid); for those the query returns the rowid instead of the data
+    tiles_type = con.execute(
+        "select type from sqlite_master where name = 'tiles';").fetchone()
+    streaming = hasattr(con, 'blobopen') and tiles_type == ('table',)
+    if streaming:
+        tiles = con.execute('''select zoom_level, tile_column, tile_row,
+            CASE WHEN length(tile_data) > 1048576 THEN NULL ELSE tile_data END,
+            CASE WHEN length(tile_data) > 1048576 THEN rowid END
+            from tiles ORDER BY zoom_level ASC;''')
+    else:
+        tiles = con.execute(
+            'select zoom_level, tile_column, tile_row, tile_data, NULL from tiles ORDER BY zoom_level ASC;')
+    # directories already made during this export
+    created = set()
+    last_zx = None
+    # files are written by a thread pool, with at most 1024 tiles in flight;
+    # blobs can only be read on this thread, so large ones are still
+    # streamed here directly
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=8) as executor:
         t = tiles.fetchone()
+        while t:
+            z = t[0]
+            x = t[1]
+            y = t[2]
+            if scheme == 'xyz':
+                y = flip_y(z,y)
+                if not silent:
+                    logger.debug('flipping')
+            if scheme == 'wms':
+                tile_dir = os.path.join(base_path,
+                    f"{z:02d}",
+                    f"{x // 1000000:03d}",
+                    f"{x // 1000 % 1000:03d}",
+                    f"{x % 1000:03d}",
+                    f"{y // 1000000:03d}",
+                    f"{y // 1000 % 1000:03d}")
+            elif (z, x) != last_zx:
+                # tiles come out grouped by column, reuse the z/x path
+                last_zx = (z, x)
+                tile_dir = os.path.join(base_path, str(z), str(x))
+            if tile_dir not in created:
+                os.makedirs(tile_dir, exist_ok=True)
+                created.add(tile_dir)
+            if scheme == 'wms':
+                tile = os.path.join(tile_dir, f"{y % 1000:03d}.{out_format}")
+            else:
+                tile = os.path.join(tile_dir, f'{y}.{image_format}')
+            if t[4] is not None:
+                with con.blobopen('tiles', 'tile_data', t[4], readonly=True) as blob:
+                    write_tile(tile, blob)
+            else:
+                pending.append(executor.submit(write_tile, tile, t[3]))
+                if len(pending) >= 1024:
+                    pending.popleft().result()
+            done = done + 1
+            if not silent:
+                logger.info('%s / %s tiles exported' % (done, count))
+            t = tiles.fetchone()
+        for future in pending:
+            future.result()
 
     # grids
-    callback = kwargs.get('callback')
     done = 0
+    # identical grid blobs (e.g. empty grids) are decompressed and parsed once
+    load_grid = lru_cache(maxsize=1024)(decode_grid)
     try:
         count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
     except sqlite3.OperationalError:
-        g = None # no grids table
-    while g:
-        zoom_level = g[0] # z
-        tile_column = g[1] # x
-        y = g[2] # y
-        grid_data_cursor = con.execute('''select key_name, key_json FROM
-            grid_data WHERE
-            zoom_level = %(zoom_level)d and
-            tile_column = %(tile_column)d and
-            tile_row = %(y)d;''' % locals() )
-        if kwargs.get('scheme') == 'xyz':
+        count = 0 # no grids table
+    grids = []
+    if count:
+        # one ordered scan of grids joined with their key/value pieces
+        grids = con.execute('''select g.zoom_level, g.tile_column, g.tile_row,
+            g.grid, gd.key_name, gd.key_json
+            FROM grids g LEFT JOIN grid_data gd
+            USING (zoom_level, tile_column, tile_row)
+            ORDER BY g.zoom_level, g.tile_column, g.tile_row;''')
+    for (zoom_level, tile_column, y), rows in groupby(grids, key=lambda r: r[:3]):
+        g = next(rows)
+        if scheme == 'xyz':
             y = flip_y(zoom_level,y)
         grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
-        if not os.path.isdir(grid_dir):
-            os.makedirs(grid_dir)
+        if grid_dir not in created:
+            os.makedirs(grid_dir, exist_ok=True)
+            created.add(grid_dir)
         grid = os.path.join(grid_dir,'%s.grid.json' % (y))
         f = open(grid, 'w')
-        grid_json = json.loads(zlib.decompress(g[3]).decode('utf-8'))
+        # copy, the cached grid is shared with other identical grids
+        grid_json = dict(load_grid(g[3]))
         # join up with the grid 'data' which is in pieces when stored in mbtiles file
-        grid_data = grid_data_cursor.fetchone()
         data = {}
-        while grid_data:
-            data[grid_data[0]] = json.loads(grid_data[1])
-            grid_data = grid_data_cursor.fetchone()
+        for grid_data in chain((g,), rows):
+            if grid_data[4] is not None:
+                data[grid_data[4]] = json.loads(grid_data[5])
         grid_json['data'] = data
         if callback in (None, "", "false", "null"):
             f.write(json.dumps(grid_json))
@@ -390,4 +498,3 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         done = done + 1
         if not silent:
             logger.info('%s / %s grids exported' % (done, count))
-        g = grids.fetchone()
@@ -1,8 +1,11 @@
+import errno
 import os, shutil
+import sqlite3
 import sys
 import json
+import zlib
 from nose import with_setup
-from mbutil import mbtiles_to_disk, disk_to_mbtiles
+from mbutil import mbtiles_to_disk, disk_to_mbtiles, flip_y, mbtiles_setup
 
 def clear_data():
     try: shutil.rmtree('test/output')
@@ -57,3 +60,198 @@ def test_disk_to_mbtiles_zyx():
     disk_to_mbtiles('test/data/tiles/zyx', 'test/output/zyx.mbtiles', scheme='zyx', format='png')
     mbtiles_to_disk('test/output/zyx.mbtiles', 'test/output/tiles', callback=None)
     assert os.path.exists('test/output/tiles/3/1/5.png')
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_journal_mode():
+    os.mkdir('test/output')
+    disk_to_mbtiles('test/data/tiles/zyx', 'test/output/zyx.mbtiles', format='png')
+    disk_to_mbtiles('test/data/tiles/zyx', 'test/output/zyx_compressed.mbtiles',
+        format='png', compression=True)
+    for name in ('zyx', 'zyx_compressed'):
+        con = sqlite3.connect('file:test/output/%s.mbtiles?mode=ro' % name, uri=True)
+        assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_compression_dedup():
+    # 5461 tiles built from 3 distinct blobs, more than one compression chunk
+    expected = {}
+    for z in range(7):
+        for x in range(2 ** z):
+            os.makedirs('test/output/tiles/%d/%d' % (z, x))
+            for y in range(2 ** z):
+                data = ('tile %d' % ((x + y) % 3)).encode('ascii')
+                with open('test/output/tiles/%d/%d/%d.png' % (z, x, y), 'wb') as f:
+                    f.write(data)
+                expected[(z, x, y)] = data
+    disk_to_mbtiles('test/output/tiles', 'test/output/dedup.mbtiles',
+        format='png', compression=True)
+    con = sqlite3.connect('test/output/dedup.mbtiles')
+    assert con.execute('select count(*) from images').fetchone()[0] == 3
+    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles')
+    assert dict(((z, x, y), data) for z, x, y, data in tiles) == expected
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_compression_schema():
+    for name, data in (('source', b'new tile'), ('dest', b'old tile')):
+        os.makedirs('test/output/%s/3/2' % name)
+        with open('test/output/%s/3/2/1.png' % name, 'wb') as f:
+            f.write(data)
+        disk_to_mbtiles('test/output/%s' % name, 'test/output/%s.mbtiles' % name,
+            format='png', compression=True)
+    con = sqlite3.connect('test/output/dest.mbtiles')
+    images = dict((c[1], c) for c in con.execute('PRAGMA table_info(images)'))
+    assert images['tile_id'][2].lower() == 'integer' and images['tile_id'][5] == 1
+    map_pk = [c[1] for c in sorted(con.execute('PRAGMA table_info(map)'), key=lambda c: c[5]) if c[5]]
+    assert map_pk == ['zoom_level', 'tile_column', 'tile_row']
+    try:
+        con.execute('select rowid from map')
+        assert False, 'map should be a WITHOUT ROWID table'
+    except sqlite3.OperationalError:
+        pass
+    indices = [r[0] for r in con.execute("select name from sqlite_master where type = 'index'")]
+    assert 'map_index' not in indices and 'images_id' not in indices
+    # the REPLACE statements of the patch script must still line up
+    statements = [l.strip().rstrip('"\\') for l in open('patch')
+        if l.strip().startswith('REPLACE INTO')]
+    assert len(statements) == 2
+    con.execute("ATTACH DATABASE 'test/output/source.mbtiles' AS source")
+    for statement in statements:
+        con.execute(statement)
+    con.commit()
+    assert con.execute('select tile_data from tiles').fetchall() == [(b'new tile',)]
+    con.close()
+
+def expected_grids(mbtiles_file, scheme):
+    # grid files as the exporter wrote them before the grids/grid_data join
+    con = sqlite3.connect(mbtiles_file)
+    expected = {}
+    for z, x, y, grid in con.execute('select zoom_level, tile_column, tile_row, grid from grids'):
+        grid_json = json.loads(zlib.decompress(grid).decode('utf-8'))
+        grid_json['data'] = dict((key, json.loads(value)) for key, value in con.execute(
+            '''select key_name, key_json FROM grid_data WHERE
+            zoom_level = ? and tile_column = ? and tile_row = ?''', (z, x, y)))
+        if scheme == 'xyz':
+            y = flip_y(z, y)
+        expected['%d/%d/%d.grid.json' % (z, x, y)] = grid_json
+    con.close()
+    return expected
+
+def exported_grids(directory_path):
+    grids = {}
+    for root, dirs, names in os.walk(directory_path):
+        for name in names:
+            if name.endswith('.grid.json'):
+                path = os.path.join(root, name)
+                grids[os.path.relpath(path, directory_path).replace(os.sep, '/')] = json.load(open(path))
+    return grids
+
+@with_setup(clear_data, clear_data)
+def test_utf8grid_mbtiles_to_disk_grid_data():
+    os.mkdir('test/output')
+    # several grids, sharing blobs and keys, one of them without any data
+    con = sqlite3.connect('test/output/grids.mbtiles')
+    mbtiles_setup(con.cursor())
+    empty = zlib.compress(json.dumps({'grid': [' '], 'keys': ['']}).encode('utf-8'))
+    full = zlib.compress(json.dumps({'grid': ['!'], 'keys': ['', '1', '2']}).encode('utf-8'))
+    for z, x, y, grid in ((1, 0, 0, full), (1, 0, 1, empty), (1, 1, 0, full), (2, 3, 1, full)):
+        con.execute('insert into grids values (?, ?, ?, ?)', (z, x, y, grid))
+        if grid is full:
+            for key in ('1', '2'):
+                con.execute('insert into grid_data values (?, ?, ?, ?, ?)',
+                    (z, x, y, key, json.dumps({'tile': [z, x, y], 'key': key})))
+    con.execute("insert into metadata values ('format', 'png')")
+    con.commit()
+    con.close()
+    for mbtiles_file in ('test/data/utf8grid.mbtiles', 'test/output/grids.mbtiles'):
+        name = os.path.splitext(os.path.basename(mbtiles_file))[0]
+        for scheme in ('xyz', 'tms', 'wms'):
+            directory_path = 'test/output/%s_%s' % (name, scheme)
+            mbtiles_to_disk(mbtiles_file, directory_path, scheme=scheme, callback=None)
+            assert exported_grids(directory_path) == expected_grids(mbtiles_file, scheme)
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_missing_grid_data():
+    os.mkdir('test/output')
+    con = sqlite3.connect('test/output/grids.mbtiles')
+    mbtiles_setup(con.cursor())
+    con.execute('insert into grids values (0, 0, 0, ?)',
+        (zlib.compress(b'{"grid": [" "], "keys": [""]}'),))
+    con.execute('drop table grid_data')
+    con.commit()
+    con.close()
+    try:
+        mbtiles_to_disk('test/output/grids.mbtiles', 'test/output/grids')
+        assert False, 'a missing grid_data table should not be skipped'
+    except sqlite3.OperationalError:
+        pass
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_large_tiles():
+    os.makedirs('test/output/tiles/1/0')
+    # one tile over 1 MiB is streamed from the blob, the small ones are
+    # written by the thread pool
+    tiles = {'0': b'small tile', '1': os.urandom(1536 * 1024)}
+    for y, data in tiles.items():
+        with open('test/output/tiles/1/0/%s.png' % y, 'wb') as f:
+            f.write(data)
+    with open('test/output/tiles/metadata.json', 'w') as f:
+        json.dump({'format': 'png'}, f)
+    disk_to_mbtiles('test/output/tiles', 'test/output/large.mbtiles')
+    mbtiles_to_disk('test/output/large.mbtiles', 'test/output/exported', scheme='tms')
+    for y, data in tiles.items():
+        assert open('test/output/exported/1/0/%s.png' % y, 'rb').read() == data
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_large_tiles_open_files():
+    import resource
+    os.makedirs('test/output/tiles/9/0')
+    for y in range(400):
+        with open('test/output/tiles/9/0/%d.png' % y, 'wb') as f:
+            f.write(b'%d' % y * 70000)
+    # more large tiles than the process may keep files open at once
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+    try:
+        disk_to_mbtiles('test/output/tiles', 'test/output/large.mbtiles', format='png')
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    con = sqlite3.connect('test/output/large.mbtiles')
+    assert con.execute('select count(*) from tiles').fetchone()[0] == 400
+    assert con.execute('select tile_data from tiles where tile_row = 7').fetchone()[0] == b'7' * 70000
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_walk():
+    # only files in z/x directories are tiles, deeper directories are not read
+    for path in ('tiles/3/2/1.png', 'tiles/3/2/deeper/4.png', 'tiles/3/stray.png', 'tiles/stray.png'):
+        path = os.path.join('test/output', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'tile')
+    # stands in for directory permissions, which do not apply when running as root
+    unreadable = []
+    real_scandir = os.scandir
+    def scandir(path='.'):
+        if os.path.normpath(path) in unreadable:
+            raise PermissionError(errno.EACCES, 'Permission denied', path)
+        return real_scandir(path)
+    os.scandir = scandir
+    try:
+        unreadable[:] = [os.path.normpath('test/output/tiles/3/2/deeper')]
+        disk_to_mbtiles('test/output/tiles', 'test/output/walk.mbtiles', format='png')
+        con = sqlite3.connect('test/output/walk.mbtiles')
+        assert con.execute('select zoom_level, tile_column, tile_row from tiles').fetchall() == [(3, 2, 1)]
+        con.close()
+        # an unreadable zoom or column directory aborts the import
+        for name, path in (('zoom', 'tiles/3'), ('column', 'tiles/3/2')):
+            unreadable[:] = [os.path.normpath(os.path.join('test/output', path))]
+            try:
+                disk_to_mbtiles('test/output/tiles', 'test/output/%s.mbtiles' % name, format='png')
+                assert False, 'an unreadable %s directory should abort the import' % name
+            except PermissionError:
+                pass
+    finally:
+        os.scandir = real_scandir